@@ -1,35 +1,44 @@
 from azure.mgmt.monitor import MonitorManagementClient
 from azure.mgmt.monitor.models import *
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 class AlertManager:
     def __init__(self, credential, subscription_id):
         self.client = MonitorManagementClient(credential, subscription_id)
         self.subscription_id = subscription_id
+        self._ds_template = f"/subscriptions/{subscription_id}/resourceGroups/{{rg}}/providers/Microsoft.OperationalInsights/workspaces/{{ws}}"
     
-    def create_log_alert(self, resource_group, alert_name, workspace_id, query, threshold=1):
+    def _build_action(self, threshold):
+        return AlertingAction(
+            severity="3",
+            trigger=TriggerCondition(
+                threshold_operator="GreaterThan",
+                threshold=threshold
+            )
+        )
+    
+    def _build_log_alert(self, resource_group, alert_name, workspace_id, query, threshold, schedule=None, action=None):
+        return LogSearchRuleResource(
+            location="global",
+            description=f"Alert for {alert_name}",
+            enabled=True,
+            source=Source(
+                query=query,
+                data_source_id=self._ds_template.format(rg=resource_group, ws=workspace_id)
+            ),
+            schedule=schedule or Schedule(
+                frequency_in_minutes=5,
+                time_window_in_minutes=5
+            ),
+            action=action or self._build_action(threshold)
+        )
+    
+    def create_log_alert(self, resource_group, alert_name, workspace_id, query, threshold=1, schedule=None, action=None):
         """Create a log analytics alert rule"""
         try:
-            criteria = LogSearchRuleResource(
-                location="global",
-                description=f"Alert for {alert_name}",
-                enabled=True,
-                source=Source(
-                    query=query,
-                    data_source_id=f"/subscriptions/{self.subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.OperationalInsights/workspaces/{workspace_id}"
-                ),
-                schedule=Schedule(
-                    frequency_in_minutes=5,
-                    time_window_in_minutes=5
-                ),
-                action=AlertingAction(
-                    severity="3",
-                    trigger=TriggerCondition(
-                        threshold_operator="GreaterThan",
-                        threshold=threshold
-                    )
-                )
-            )
+            criteria = self._build_log_alert(resource_group, alert_name, workspace_id, query, threshold, schedule, action)
             
             result = self.client.scheduled_query_rules.create_or_update(
                 resource_group_name=resource_group,
@@ -42,8 +51,52 @@ class AlertManager:
         except Exception as e:
             return {"status": "error", "message": str(e)}
     
-    def list_alerts(self, resource_group=None):
-        """List all alert rules"""
+    def create_log_alerts_bulk(self, resource_group, workspace_id, specs, max_workers=4):
+        """Create several alert rules concurrently from specs with alert_name, query and optional threshold"""
+        # Reject malformed specs before any rule is created remotely
+        invalid = [
+            i for i, spec in enumerate(specs)
+            if not isinstance(spec, dict) or not spec.get("alert_name") or not spec.get("query")
+            or not isinstance(spec.get("threshold", 1), (int, float))
+        ]
+        if invalid:
+            return {"status": "error", "message": f"Specs missing alert_name or query, or with a non-numeric threshold, at positions {invalid}"}
+        
+        # Every rule in the batch shares one schedule and one action per distinct threshold
+        schedule = Schedule(
+            frequency_in_minutes=5,
+            time_window_in_minutes=5
+        )
+        actions = {threshold: self._build_action(threshold) for threshold in {spec.get("threshold", 1) for spec in specs}}
+        
+        def create(spec):
+            threshold = spec.get("threshold", 1)
+            result = self.create_log_alert(
+                resource_group,
+                spec["alert_name"],
+                workspace_id,
+                spec["query"],
+                threshold=threshold,
+                schedule=schedule,
+                action=actions[threshold]
+            )
+            return {"alert_name": spec["alert_name"], **result}
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(create, specs))
+        
+        failed = sum(1 for result in results if result["status"] != "success")
+        if not failed:
+            status = "success"
+        elif failed == len(results):
+            status = "error"
+        else:
+            status = "partial"
+        
+        return {"status": status, "results": results}
+    
+    def list_alerts(self, resource_group=None, max_results=None):
+        """List alert rules, stopping after max_results if given"""
         try:
             if resource_group:
                 alerts = self.client.scheduled_query_rules.list_by_resource_group(resource_group)
@@ -52,6 +105,8 @@ class AlertManager:
             
             alert_list = []
             for alert in alerts:
+                if max_results is not None and len(alert_list) >= max_results:
+                    break
                 alert_list.append({
                     "name": alert.name,
                     "id": alert.id,
@@ -64,24 +119,34 @@ class AlertManager:
         except Exception as e:
             return {"status": "error", "message": str(e)}
     
-    def get_alert_history(self, resource_group, alert_name, days=7):
+    def get_alert_history(self, resource_group, alert_name, days=7, max_pages=10):
         """Get alert firing history"""
         try:
-            # Query activity log for alert events
-            filter_str = f"eventTimestamp ge '{days}' and resourceGroupName eq '{resource_group}' and operationName.value eq 'Microsoft.Insights/scheduledQueryRules/write'"
+            # Let the activity log filter by time window and the exact rule
+            cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+            rule_id = f"/subscriptions/{self.subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.Insights/scheduledQueryRules/{alert_name}"
+            filter_str = f"eventTimestamp ge '{cutoff.strftime('%Y-%m-%dT%H:%M:%SZ')}' and resourceUri eq '{rule_id}'"
             
-            events = self.client.activity_logs.list(filter=filter_str)
+            pages = self.client.activity_logs.list(filter=filter_str).by_page()
             
             history = []
-            for event in events:
-                if alert_name in event.resource_id:
+            truncated = False
+            # The eventTimestamp filter bounds the window server-side, so just walk the pages
+            for page_number, page in enumerate(pages, 1):
+                for event in page:
+                    if event.operation_name and event.operation_name.value != "Microsoft.Insights/scheduledQueryRules/write":
+                        continue
                     history.append({
                         "timestamp": event.event_timestamp.isoformat(),
                         "status": event.status.value,
                         "description": event.description
                     })
+                if page_number >= max_pages:
+                    # A continuation token means more pages remain; don't fetch them
+                    truncated = pages.continuation_token is not None
+                    break
             
-            return {"status": "success", "history": history}
+            return {"status": "success", "history": history, "truncated": truncated}
             
         except Exception as e:
             return {"status": "error", "message": str(e)}
@@ -29,10 +29,12 @@ SECURITY_QUERIES = {
     }
 }
 
+_SECURITY_QUERY_LIST = tuple({"name": name, "description": data["description"]} for name, data in SECURITY_QUERIES.items())
+
 def get_security_query(query_name):
     """Get a predefined security query"""
     return SECURITY_QUERIES.get(query_name)
 
 def list_security_queries():
     """List all available security queries"""
-    return [{"name": name, "description": data["description"]} for name, data in SECURITY_QUERIES.items()]
+    return _SECURITY_QUERY_LIST
@@ -1,67 +1,224 @@
 #!/usr/bin/env python3
 import asyncio
-import json
 import csv
-import io
+import functools
+import itertools
+import logging
 import re
+import time
+from collections import namedtuple
 from typing import Any, Dict, List
 from mcp.server import Server
 from mcp.server.models import InitializationOptions
 import mcp.server.stdio
 import mcp.types as types
-from azure.monitor.query import LogsQueryClient
-from azure.identity import DefaultAzureCredential
+import orjson
+from azure.monitor.query.aio import LogsQueryClient
+from azure.identity.aio import DefaultAzureCredential
 import os
 
 server = Server("azure-logs-mcp")
+logger = logging.getLogger(__name__)
+
+# Saved queries persist to a JSON file across restarts
+SAVED_QUERIES_PATH = os.environ.get(
+    "SAVED_QUERIES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "saved_queries.json"),
+)
+
+def _set_aside_corrupt_file(path):
+    # Keep the unreadable file so the next save_query doesn't overwrite the user's queries
+    try:
+        os.replace(path, path + '.corrupt')
+        logger.warning("Moved unreadable saved queries file to %s.corrupt", path)
+    except OSError as e:
+        logger.warning("Could not move unreadable saved queries file %s aside: %s", path, e)
+
+def load_saved_queries(path=SAVED_QUERIES_PATH):
+    try:
+        with open(path, 'rb') as f:
+            queries = orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable saved queries file %s: %s", path, e)
+        _set_aside_corrupt_file(path)
+        return {}
+    
+    if not isinstance(queries, dict):
+        logger.warning("Ignoring saved queries file %s: expected a JSON object", path)
+        _set_aside_corrupt_file(path)
+        return {}
+    
+    valid = {}
+    for name, data in queries.items():
+        if isinstance(data, dict) and isinstance(data.get("query"), str):
+            valid[name] = {"query": data["query"], "description": str(data.get("description", ""))}
+        else:
+            logger.warning("Dropping malformed saved query %r from %s", name, path)
+    return valid
+
+def persist_saved_queries(queries, path=SAVED_QUERIES_PATH):
+    # Write to a temp file and swap it in so readers never see a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(queries, option=orjson.OPT_INDENT_2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 # Global client instance and saved queries
 logs_client = None
-saved_queries = {}
+saved_queries = load_saved_queries()
+_saved_queries_lock = asyncio.Lock()
+
+# Shared credential; the single async logs client owns one aiohttp connection pool
+_credential = None
+
+def get_shared_credential():
+    global _credential
+    if _credential is None:
+        _credential = DefaultAzureCredential()
+    return _credential
+
+# Precompiled KQL validation patterns
+_KQL_TABLE_RE = re.compile(r'^[A-Za-z_]\w*')
+_WS_RE = re.compile(r'\S')
+KQL_KEYWORDS = frozenset(['where', 'project', 'summarize', 'order', 'limit', 'join', 'union', 'extend', 'parse'])
 
-def format_results(results, format_type="json", limit=1000):
+# Workspace metadata caches: key -> (timestamp, value)
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_ENTRIES = 256
+_tables_cache: Dict[str, tuple] = {}
+_schema_cache: Dict[tuple, tuple] = {}
+
+def _cache_get(cache, key):
+    entry = cache.get(key)
+    if entry and time.monotonic() - entry[0] < CACHE_TTL_SECONDS:
+        return entry[1]
+    return None
+
+def _cache_put(cache, key, value):
+    cache.pop(key, None)
+    if len(cache) >= CACHE_MAX_ENTRIES:
+        # Dicts keep insertion order, so the first key is the oldest entry
+        del cache[next(iter(cache))]
+    cache[key] = (time.monotonic(), value)
+
+def _dumps(obj, indent=True):
+    # Pass datetimes through to default=str so they render as they do in csv/table output
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, option=option, default=str).decode()
+
+@functools.lru_cache(maxsize=64)
+def _row_cls(columns):
+    # rename=True mangles field names such as _ResourceId, so rows are read by position
+    return namedtuple('Row', columns, rename=True)
+
+def _align(columns, row, headers):
+    # Rows are read positionally; only realign rows from a table with a different schema
+    if columns == headers:
+        return row
+    values = dict(zip(columns, row))
+    return [values.get(h, "") for h in headers]
+
+def _union_columns(tables):
+    # Ordered union of every table's columns so no column is dropped from a shared header
+    return tuple(dict.fromkeys(column for table in tables for column in table.columns))
+
+def _flatten(response, kind="dict"):
+    """Yield rows from every table in a query response as dicts, Row tuples or raw rows"""
+    # Raw and Row rows follow the union of all tables' columns; other schemas are realigned by name
+    headers = _union_columns(response.tables)
+    for table in response.tables:
+        columns = tuple(table.columns)
+        if kind == "raw":
+            if columns == headers:
+                yield from table.rows
+            else:
+                for row in table.rows:
+                    yield _align(columns, row, headers)
+        elif kind == "row":
+            make = _row_cls(headers)._make
+            for row in table.rows:
+                yield make(_align(columns, row, headers))
+        else:
+            for row in table.rows:
+                yield dict(zip(columns, row))
+
+class _ChunkWriter:
+    """File-like sink that collects csv writer output for a single join"""
+    def __init__(self):
+        self.chunks = []
+        self.write = self.chunks.append
+
+def format_results(results, format_type="json", headers=None):
+    # json takes dict rows; csv and table take positional rows in the order of headers
     if not results:
         return "No results found"
     
-    limited_results = results[:limit] if len(results) > limit else results
+    if format_type in ("csv", "table") and headers is None:
+        raise ValueError(f"headers are required for {format_type} output")
     
     if format_type == "csv":
-        if not limited_results:
-            return ""
-        output = io.StringIO()
-        writer = csv.DictWriter(output, fieldnames=limited_results[0].keys())
-        writer.writeheader()
-        writer.writerows(limited_results)
-        return output.getvalue()
+        output = _ChunkWriter()
+        writer = csv.writer(output)
+        writer.writerow(headers)
+        writer.writerows(results)
+        return "".join(output.chunks)
     elif format_type == "table":
-        if not limited_results:
-            return ""
-        headers = list(limited_results[0].keys())
-        rows = [[str(row.get(h, "")) for h in headers] for row in limited_results]
-        col_widths = [max(len(h), max(len(r[i]) for r in rows)) for i, h in enumerate(headers)]
+        # Stringify cells and track column widths in a single pass
+        col_widths = [len(h) for h in headers]
+        rows = []
+        # Bind hot-loop callables to locals to skip global lookups per row
+        _str = str
+        for row in results:
+            srow = list(map(_str, row))
+            for i, cell in enumerate(srow):
+                if len(cell) > col_widths[i]:
+                    col_widths[i] = len(cell)
+            rows.append(srow)
         
         header_row = " | ".join(h.ljust(w) for h, w in zip(headers, col_widths))
         separator = "-+-".join("-" * w for w in col_widths)
-        data_rows = [" | ".join(r[i].ljust(col_widths[i]) for i in range(len(headers))) for r in rows]
+        data_rows = [" | ".join(cell.ljust(w) for cell, w in zip(r, col_widths)) for r in rows]
         
         return "\n".join([header_row, separator] + data_rows)
     else:
-        return json.dumps(limited_results, indent=2, default=str)
+        return _dumps(results)
 
-def validate_kql_syntax(query):
+def format_compact(tables, limit=1000):
+    # Columns listed once per table with positional rows, avoiding a dict per row
+    payload = []
+    remaining = limit
+    for table in tables:
+        rows = [list(row) for row in table.rows[:remaining]]
+        payload.append({"columns": list(table.columns), "rows": rows})
+        if remaining is not None:
+            remaining -= len(rows)
+            if remaining <= 0:
+                break
+    return _dumps(payload, indent=False)
+
+@functools.lru_cache(maxsize=1024)
+def _validate_kql_cached(query: str):
     # Basic KQL validation
-    if not query.strip():
+    if not _WS_RE.search(query):
         return False, "Empty query"
     
     # Check for basic KQL structure
-    kql_keywords = ['where', 'project', 'summarize', 'order', 'limit', 'join', 'union', 'extend', 'parse']
-    has_table = bool(re.search(r'^[A-Za-z_][A-Za-z0-9_]*', query.strip()))
+    has_table = _KQL_TABLE_RE.match(query.lstrip()) is not None
     
     if not has_table:
         return False, "Query must start with a table name"
     
     return True, "Valid syntax"
 
+def validate_kql_syntax(query):
+    return _validate_kql_cached(query)
+
 @server.list_tools()
 async def handle_list_tools() -> List[types.Tool]:
     return [
@@ -74,7 +231,7 @@ async def handle_list_tools() -> List[types.Tool]:
                     "workspace_id": {"type": "string", "description": "Azure Log Analytics workspace ID"},
                     "query": {"type": "string", "description": "KQL query to execute"},
                     "timespan": {"type": "string", "description": "Time range", "default": "PT1H"},
-                    "format": {"type": "string", "enum": ["json", "csv", "table"], "default": "json"},
+                    "format": {"type": "string", "enum": ["json", "json_compact", "csv", "table"], "default": "json"},
                     "limit": {"type": "integer", "description": "Max rows to return", "default": 1000}
                 },
                 "required": ["workspace_id", "query"]
@@ -158,6 +315,11 @@ async def handle_list_tools() -> List[types.Tool]:
                 },
                 "required": ["workspace_id", "query", "filename"]
             }
+        ),
+        types.Tool(
+            name="clear_validation_cache",
+            description="Clear the cached KQL validation results",
+            inputSchema={"type": "object", "properties": {}}
         )
     ]
 
@@ -167,8 +329,7 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
     
     if not logs_client:
         try:
-            credential = DefaultAzureCredential()
-            logs_client = LogsQueryClient(credential)
+            logs_client = LogsQueryClient(get_shared_credential())
         except Exception as e:
             return [types.TextContent(type="text", text=f"Failed to initialize Azure client: {str(e)}")]
     
@@ -180,15 +341,19 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         limit = arguments.get("limit", 1000)
         
         try:
-            response = logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan=timespan)
+            # None means no limit; islice rejects negative stops
+            if limit is not None:
+                limit = max(limit, 0)
+            response = await logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan=timespan)
             
             if response.tables:
-                results = []
-                for table in response.tables:
-                    rows = [dict(zip(table.columns, row)) for row in table.rows]
-                    results.extend(rows)
+                if format_type == "json_compact":
+                    return [types.TextContent(type="text", text=format_compact(response.tables, limit))]
+                
+                kind = "row" if format_type in ("csv", "table") else "dict"
+                results = list(itertools.islice(_flatten(response, kind=kind), limit))
                 
-                formatted = format_results(results, format_type, limit)
+                formatted = format_results(results, format_type, headers=_union_columns(response.tables))
                 return [types.TextContent(type="text", text=formatted)]
             else:
                 return [types.TextContent(type="text", text="No results found")]
@@ -202,6 +367,12 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         description = arguments.get("description", "")
         
         saved_queries[name_key] = {"query": query, "description": description}
+        try:
+            # Write off the event loop; the lock keeps concurrent saves from sharing the temp file
+            async with _saved_queries_lock:
+                await asyncio.to_thread(persist_saved_queries, dict(saved_queries))
+        except OSError as e:
+            return [types.TextContent(type="text", text=f"Query '{name_key}' saved for this session but could not be persisted: {str(e)}")]
         return [types.TextContent(type="text", text=f"Query '{name_key}' saved successfully")]
     
     elif name == "list_saved_queries":
@@ -212,7 +383,7 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         for name, data in saved_queries.items():
             query_list.append({"name": name, "description": data["description"], "query": data["query"]})
         
-        return [types.TextContent(type="text", text=json.dumps(query_list, indent=2))]
+        return [types.TextContent(type="text", text=_dumps(query_list))]
     
     elif name == "run_saved_query":
         workspace_id = arguments["workspace_id"]
@@ -225,15 +396,12 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         query = saved_queries[query_name]["query"]
         
         try:
-            response = logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan=timespan)
+            response = await logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan=timespan)
             
             if response.tables:
-                results = []
-                for table in response.tables:
-                    rows = [dict(zip(table.columns, row)) for row in table.rows]
-                    results.extend(rows)
+                results = list(_flatten(response))
                 
-                return [types.TextContent(type="text", text=json.dumps(results, indent=2, default=str))]
+                return [types.TextContent(type="text", text=_dumps(results))]
             else:
                 return [types.TextContent(type="text", text="No results found")]
                 
@@ -245,20 +413,27 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         is_valid, message = validate_kql_syntax(query)
         
         result = {"valid": is_valid, "message": message}
-        return [types.TextContent(type="text", text=json.dumps(result, indent=2))]
+        return [types.TextContent(type="text", text=_dumps(result))]
+    
+    elif name == "clear_validation_cache":
+        _validate_kql_cached.cache_clear()
+        return [types.TextContent(type="text", text="Validation cache cleared")]
     
     elif name == "list_tables":
         workspace_id = arguments["workspace_id"]
         
         try:
-            query = "search * | distinct $table | sort by $table asc"
-            response = logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan="P30D")
-            
-            tables = []
-            if response.tables and response.tables[0].rows:
-                tables = [row[0] for row in response.tables[0].rows]
+            tables = _cache_get(_tables_cache, workspace_id)
+            if tables is None:
+                query = "search * | distinct $table | sort by $table asc"
+                response = await logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan="P30D")
+                
+                tables = []
+                if response.tables and response.tables[0].rows:
+                    tables = [row[0] for row in response.tables[0].rows]
+                _cache_put(_tables_cache, workspace_id, tables)
             
-            return [types.TextContent(type="text", text=json.dumps({"tables": tables}, indent=2))]
+            return [types.TextContent(type="text", text=_dumps({"tables": tables}))]
             
         except Exception as e:
             return [types.TextContent(type="text", text=f"Failed to list tables: {str(e)}")]
@@ -268,12 +443,19 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         table_name = arguments["table_name"]
         
         try:
-            query = f"{table_name} | getschema | project ColumnName, DataType, ColumnType"
-            response = logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan="P1D")
+            cache_key = (workspace_id, table_name)
+            schema = _cache_get(_schema_cache, cache_key)
+            if schema is None:
+                query = f"{table_name} | getschema | project ColumnName, DataType, ColumnType"
+                response = await logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan="P1D")
+                
+                schema = []
+                if response.tables and response.tables[0].rows:
+                    schema = [dict(zip(response.tables[0].columns, row)) for row in response.tables[0].rows]
+                    _cache_put(_schema_cache, cache_key, schema)
             
-            if response.tables and response.tables[0].rows:
-                schema = [dict(zip(response.tables[0].columns, row)) for row in response.tables[0].rows]
-                return [types.TextContent(type="text", text=json.dumps({"table": table_name, "schema": schema}, indent=2))]
+            if schema:
+                return [types.TextContent(type="text", text=_dumps({"table": table_name, "schema": schema}))]
             else:
                 return [types.TextContent(type="text", text=f"No schema found for table {table_name}")]
                 
@@ -287,25 +469,30 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
         format_type = arguments.get("format", "csv")
         
         try:
-            response = logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan="PT24H")
+            response = await logs_client.query_workspace(workspace_id=workspace_id, query=query, timespan="PT24H")
             
             if response.tables:
-                results = []
-                for table in response.tables:
-                    rows = [dict(zip(table.columns, row)) for row in table.rows]
-                    results.extend(rows)
+                row_count = sum(len(table.rows) for table in response.tables)
                 
+                # Stream rows straight to disk rather than building an in-memory result list
                 if format_type == "csv":
                     with open(filename, 'w', newline='') as f:
-                        if results:
-                            writer = csv.DictWriter(f, fieldnames=results[0].keys())
-                            writer.writeheader()
-                            writer.writerows(results)
+                        if row_count:
+                            writer = csv.writer(f)
+                            writer.writerow(_union_columns(response.tables))
+                            writer.writerows(_flatten(response, kind="raw"))
                 else:
                     with open(filename, 'w') as f:
-                        json.dump(results, f, indent=2, default=str)
+                        f.write('[')
+                        first = True
+                        for record in _flatten(response):
+                            f.write('\n  ' if first else ',\n  ')
+                            first = False
+                            # Indent each object one level to keep the layout of an indented list
+                            f.write(_dumps(record).replace('\n', '\n  '))
+                        f.write(']' if first else '\n]')
                 
-                return [types.TextContent(type="text", text=f"Results exported to {filename} ({len(results)} rows)")]
+                return [types.TextContent(type="text", text=f"Results exported to {filename} ({row_count} rows)")]
             else:
                 return [types.TextContent(type="text", text="No results to export")]
                 
@@ -315,19 +502,26 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
     return [types.TextContent(type="text", text=f"Unknown tool: {name}")]
 
 async def main():
-    async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="azure-logs-mcp",
-                server_version="0.1.0",
-                capabilities=server.get_capabilities(
-                    notification_options=None,
-                    experimental_capabilities=None,
+    try:
+        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="azure-logs-mcp",
+                    server_version="0.1.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=None,
+                        experimental_capabilities=None,
+                    ),
                 ),
-            ),
-        )
+            )
+    finally:
+        # Close the aiohttp session pools held by the async Azure clients
+        if logs_client:
+            await logs_client.close()
+        if _credential:
+            await _credential.close()
 
 if __name__ == "__main__":
     asyncio.run(main())